@@ -16,65 +16,145 @@
 import cv2 as cv
 import numpy as np
 import pyaudio
-import multiprocessing
-from multiprocessing import Process
+import threading
+import queue
+import os
 import sys
 import stimulus as stim
 
 
-def point_inside(rect, point):
-    in_roi = None
-    test = cv.pointPolygonTest(np.array([(rect[0], rect[1]), 
-                                (rect[0] + rect[2], rect[1]), 
-                                (rect[0] + rect[2], rect[1] + rect[3]), 
-                                (rect[0], rect[1] + rect[3])], dtype=np.float32), 
-                                np.array((point[0], point[1]), dtype=np.float32), False)
-    if test >= 0:
-        in_roi = True
-        color = (255,0,0)
-    else:
-        in_roi = False
-        color = (0,255,0)
-    
-    return in_roi, color
-
-
-def trigger_stim(play_stim, end_stream, wave):
-    p = pyaudio.PyAudio()
-
-    while True:
-        play_stim.wait()
-        stim_stream = p.open(format=pyaudio.paFloat32,
-                            channels=1,
-                            rate=44100,
-                            output=True,
-                            frames_per_buffer=1024)
-        stim_stream.write(wave)
-        stim_stream.close()
-
-        play_stim.clear()
-
-        if end_stream.is_set():
-            stim_stream.close()
-            p.terminate()
-            break
+# raise the scheduling priority of the calling thread, keeping the default
+# where the platform or permissions don't allow it
+def raise_priority():
+    try:
+        os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(80))
+    except (AttributeError, OSError):
+        try:
+            os.nice(-10)
+        except (AttributeError, OSError):
+            pass
 
 
-def play_sound(end_stream, background):
+def start_audio(background, wave, play_stim):
     p = pyaudio.PyAudio()
-
-    cont_stream = p.open(format=pyaudio.paFloat32,
+    pos = 0
+    stim_pos = len(wave)  # stimulus idle until triggered
+    prioritized = False
+
+    # Loop the background and mix in the stimulus once play_stim is set
+    def callback(in_data, frame_count, time_info, status):
+        nonlocal pos, stim_pos, prioritized
+        if not prioritized:
+            # Runs on the PortAudio thread, so only that thread is affected
+            raise_priority()
+            prioritized = True
+
+        end = pos + frame_count
+        if end <= len(background):
+            out = background[pos:end]
+        else:
+            end -= len(background)
+            out = np.concatenate((background[pos:], background[:end]))
+        pos = end
+
+        # Latch a trigger on the next callback, triggers that arrive while the
+        # stimulus is still playing are dropped
+        if play_stim.is_set():
+            play_stim.clear()
+            if stim_pos >= len(wave):
+                stim_pos = 0
+
+        if stim_pos < len(wave):
+            # Mix in int32 so the sum can be clipped instead of wrapping
+            chunk = wave[stim_pos:stim_pos + frame_count]
+            out = out.astype(np.int32)
+            out[:len(chunk)] += chunk
+            out = np.clip(out, -32768, 32767).astype(np.int16)
+            stim_pos += len(chunk)
+
+        return (out.tobytes(), pyaudio.paContinue)
+
+    stream = p.open(format=pyaudio.paInt16,
                     channels=1,
                     rate=44100,
                     output=True,
-                    frames_per_buffer=1024)
-    while not end_stream.is_set():
-        cont_stream.write(background)
- 
-    cont_stream.stop_stream()
-    cont_stream.close()
-    p.terminate()
-    return
+                    frames_per_buffer=256,
+                    stream_callback=callback)
+
+    return p, stream
+
+
+# put a frame on a pipeline queue, giving up if the queue stays full after
+# the pipeline has been stopped
+def put_frame(q, frame, stop):
+    while True:
+        try:
+            q.put(frame, timeout=0.1)
+            return True
+        except queue.Full:
+            if stop.is_set():
+                return False
+
+
+def capture_frames(cap, q_frames, stop):
+    # Always send the end marker so the tracking thread can't wait forever
+    try:
+        while not stop.is_set():
+            # Read a new frame
+            ret, frame = cap.read()
+            if not ret:
+                break
+            if not put_frame(q_frames, frame, stop):
+                break
+    finally:
+        put_frame(q_frames, None, stop)
+
+
+def track_frames(tracker, rect, play_stim, centroid_log, q_frames, q_out, stop):
+    # Unpack the trigger region once, it is fixed for the whole recording
+    x0, y0, w, h = rect
+    rect_pt1 = (int(x0), int(y0))
+    rect_pt2 = (int(x0 + w), int(y0 + h))
+
+    # Start outside the region so the first frame can trigger on entry
+    prev_state = False
+    in_roi = False
+
+    # Always send the end marker so the main thread can't wait forever
+    try:
+        while True:
+            frame = q_frames.get()
+            if frame is None:
+                break
+
+            # Update the tracking result before the trigger region is drawn
+            success, roi = tracker.update(frame)
+
+            if success:
+                center = (int(roi[0] + roi[2] / 2), int(roi[1] + roi[3] / 2))
+                in_roi = (x0 <= center[0] < x0 + w) and (y0 <= center[1] < y0 + h)
+
+            # Trigger before drawing so the stimulus is not delayed by annotation
+            if in_roi and not prev_state:
+                play_stim.set()
+
+            prev_state = in_roi
+
+            cv.rectangle(frame, rect_pt1, rect_pt2, (0, 255, 0), 2)
+
+            if success:
+                # Draw the tracked object
+                radius = 10  # circle radius
+                color = (255,0,0) if in_roi else (0,255,0)
+                cv.circle(frame, center, radius, color, -1)  # draw green circle at center point
+
+                # Add center to the log
+                centroid_log.append((center[0], center[1], in_roi))
+
+            if not put_frame(q_out, frame, stop):
+                break
+    finally:
+        put_frame(q_out, None, stop)
 
 
 # convert arg value to int if its a number
@@ -136,10 +216,9 @@ if __name__ == "__main__":
     global background
     background = stim.noise_generator(min_amp, 50, 44100)
     hanning_window = int(fs * 0.5)
-    hanning = np.hanning(hanning_window)
-    rev_hanning = hanning[::-1]
-    background[0:(hanning_window//2)] = background[0:hanning_window//2] * hanning[:(hanning_window//2)]
-    background[-(hanning_window//2):] = background[-(hanning_window//2):] * rev_hanning[:(hanning_window//2)]
+    half = np.hanning(hanning_window)[:hanning_window//2].astype(np.float32)
+    background[:half.size] *= half
+    background[-half.size:] *= half[::-1]
 
     # Create the stimulus wave
     # global wave
@@ -147,15 +226,16 @@ if __name__ == "__main__":
     # plt.plot(wave)
     # plt.show()
 
+    # Quantize both sounds once so the audio callback only moves int16 samples
+    background = stim.to_int16(background)
+    wave = stim.to_int16(wave)
+
     # Initialize the tracker
     tracker = cv.TrackerKCF_create()
 
     # Perform the tracking process
     print("Starting the tracking process, pres ESC to quit.")
 
-    # Create a csv file to save centroid location
-    csv = open("centroid.csv", "w")
-
     # Declare an ROI if there isn't one already 
     roi = None
     while roi is None:
@@ -177,65 +257,69 @@ if __name__ == "__main__":
         
     cv.destroyAllWindows()
 
-    # Create event that will trigger stimulus playback and end the stream 
-    play_stim = multiprocessing.Event()
-    end_stream = multiprocessing.Event()
-
-    # Create threads that will handle the audio playback: 
-    sound_thread = Process(target=play_sound, args=(end_stream, background))
-    stim_thread = Process(target=trigger_stim, args=(play_stim, end_stream, wave))
-    sound_thread.start()
-    stim_thread.start()
-
-    # Create a csv file to save centroid location
-    csv = open("centroid.csv", "w")
-
-    # Loop over all frames
-    while True:
-        # Read a new frame
-        ret, frame = cap.read()
-        if not ret:
-            break
-
-        cv.rectangle(frame, (int(rect[0]), int(rect[1])), (int(rect[0]+rect[2]), int(rect[1]+rect[3])), (0, 255, 0), 2)
-
-        # Update the tracking result
-        success, roi = tracker.update(frame)
-
-        if success:
-            # Draw the tracked object
-            center = (int(roi[0] + roi[2] / 2), int(roi[1] + roi[3] / 2))
-            radius = 10  # circle radius
-            in_roi, color = point_inside(rect, center)
-            cv.circle(frame, center, radius, color, -1)  # draw green circle at center point
-
-            # Add center to csv
-            csv.write(str(center[0]) + "," + str(center[1]) + "," + str(in_roi) +"\n")
-
-        if in_roi and in_roi != prev_state:
-            play_stim.set()
+    # Create event that will trigger stimulus playback
+    play_stim = threading.Event()
 
-        prev_state = in_roi
+    # Start the audio stream, the stimulus is mixed into the background
+    p, audio_stream = start_audio(background, wave, play_stim)
 
-        # Show image with the tracked object
-        cv.imshow("tracker", frame)
+    # Collect centroid locations, written to csv once tracking ends
+    centroid_log = []
 
-        # Write the frame to the output video
-        outputVid.write(frame)
-
-        # Quit on ESC button
-        if cv.waitKey(1) == 27:
-            end_stream.set()
-            break
+    # Capture and tracking run in their own threads, encode and display stay
+    # on the main thread since imshow/waitKey must be called from it
+    q_frames = queue.Queue(maxsize=2)
+    q_out = queue.Queue(maxsize=2)
+    stop = threading.Event()
+    cap_thread = threading.Thread(target=capture_frames, args=(cap, q_frames, stop))
+    track_thread = threading.Thread(
+        target=track_frames,
+        args=(tracker, rect, play_stim, centroid_log, q_frames, q_out, stop),
+    )
+    cap_thread.start()
+    track_thread.start()
 
-    # Release resources
-    cap.release()
-    outputVid.release()
-    cv.destroyAllWindows()
-    csv.close()
-    
-    # Close threads
-    stim_thread.terminate()
-    sound_thread.terminate()
+    # Always stop the threads and save the centroids, even if the loop fails
+    try:
+        # Loop over all tracked frames
+        while True:
+            try:
+                frame = q_out.get(timeout=0.05)
+            except queue.Empty:
+                # Keep the window responsive and ESC working while tracking stalls
+                if cv.waitKey(1) == 27:
+                    break
+                continue
+            if frame is None:
+                break
+
+            # Show image with the tracked object
+            cv.imshow("tracker", frame)
+
+            # Write the frame to the output video
+            outputVid.write(frame)
+
+            # Quit on ESC button
+            if cv.waitKey(1) == 27:
+                break
+    finally:
+        # Stop the pipeline threads
+        stop.set()
+        cap_thread.join()
+        track_thread.join()
+
+        # Save centroid locations
+        with open("centroid.csv", "w") as csv:
+            csv.writelines(f"{x},{y},{r}\n" for x, y, r in centroid_log)
+
+        # Release resources
+        cap.release()
+        outputVid.release()
+        cv.destroyAllWindows()
+
+        # Close the audio stream
+        audio_stream.stop_stream()
+        audio_stream.close()
+        p.terminate()
 
     print("Finished tracking video")
@@ -1,5 +1,9 @@
 import pyaudio
 import numpy as np
+from functools import lru_cache
+
+
+_rng = np.random.default_rng()
 
 
 def isfloat(num):
@@ -10,23 +14,39 @@ def isfloat(num):
         return False
 
 
+# float32 gaussian noise with mean 0.5 and sd 0.1
+def gaussian_noise(n):
+    noise = _rng.standard_normal(n, dtype=np.float32)
+    noise *= 0.1
+    noise += 0.5
+    return noise
+
+
+# 0-1 ramp of the given length, shared between calls
+@lru_cache(maxsize=None)
+def unit_ramp(window):
+    ramp = np.linspace(0, 1, window, dtype=np.float32)
+    ramp.flags.writeable = False
+    return ramp
+
+
 def noise_generator(amplitude, duration, fs): 
-    t = np.linspace(0, duration, int(duration * fs), endpoint=False)
-    noise = np.random.normal(0.5,0.1,(fs * duration))
-    wave = amplitude * noise
+    n = fs * duration
+    noise = gaussian_noise(n)
+    wave = np.empty(n, dtype=np.float32)
 
     # Ramp the signal at the beginning and end
     window = int(fs * 0.25) # elements in first 1/4s
-    ramp_vector = np.linspace(0, amplitude, num=window)
-    wave[0:window] = ramp_vector
+    ramp = amplitude * unit_ramp(window)
+    wave[:window] = ramp * noise[:window]
+    wave[window:-window] = amplitude * noise[window:-window]
+    wave[-window:] = ramp[::-1] * noise[-window:]
 
-    end_window = len(wave) - window
-    end_ramp = ramp_vector[::-1]
-    wave[end_window:len(wave)] = end_ramp
+    return wave
 
-    wave = wave * noise
-    
-    return wave.astype(np.float32)
+
+def to_int16(wave):
+    return (np.clip(wave, -1, 1) * 32767).astype(np.int16)
 
 
 def calibrate(amplitude):
@@ -63,17 +83,13 @@ def wave_generator(base, peak):
     fs = 44100
 
     # Create the period for rising wave
-    rise = np.linspace(base, peak, int(fs * 0.4))
-    base_vec = np.array(base)
-    base_vec = np.repeat(base_vec, int(fs * 0.6))
+    rise = np.linspace(base, peak, int(fs * 0.4), dtype=np.float32)
+    base_vec = np.full(int(fs * 0.6), base, dtype=np.float32)
 
     period = np.concatenate([rise, base_vec])
 
-    # Repeat period for duration
+    # Repeat period for duration and apply the noise in place
     wave = np.tile(period, duration)
+    wave *= gaussian_noise(fs * duration)
 
-    noise = np.random.normal(0.5,0.1, (fs * duration))
-    wave = wave * noise
-    
-    return wave.astype(np.float32)
-
+    return wave